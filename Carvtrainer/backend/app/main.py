@@ -4,841 +4,1289 @@ Flask server that uses Claude AI to analyze CARV screenshots and generate traini
 """
 
 import os
+import asyncio
 import base64
-import json
+import functools
+import hashlib
+import logging
+import math
 import re
+import string
+import struct
+import threading
+import zlib
+import httpx
+from collections import OrderedDict
 from io import BytesIO
+from pathlib import Path
 from datetime import datetime
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from anthropic import Anthropic
+from flask import Flask, Response, request, stream_with_context
+from anthropic import Anthropic, AsyncAnthropic
+from diskcache import Cache
+import orjson
 from dotenv import load_dotenv
 from PIL import Image
-from PIL.ExifTags import TAGS
+
+# Optional faster resize/encode path; pyvips raises OSError when libvips itself is missing
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app, origins=["http://localhost:3000", "http://127.0.0.1:3000"])
 
-# Initialize Anthropic client
-client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+# Flask's logger only logs INFO in debug mode by default; prompt-cache usage is
+# logged at INFO and should show up under gunicorn too
+app.logger.setLevel(logging.INFO)
+
+# Origins allowed to call the API directly (the Vite dev server)
+ALLOWED_ORIGINS = frozenset({"http://localhost:3000", "http://127.0.0.1:3000"})
+
+
+@app.after_request
+def add_cors_headers(response):
+    """Allow cross-origin requests from ALLOWED_ORIGINS only."""
+    origin = request.headers.get("Origin")
+    if origin in ALLOWED_ORIGINS:
+        response.headers["Access-Control-Allow-Origin"] = origin
+        if request.method == "OPTIONS":
+            response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+            response.headers["Access-Control-Allow-Headers"] = "Content-Type, Accept"
+    response.headers.add("Vary", "Origin")
+    return response
+
+
+@app.before_request
+def reject_oversized_requests():
+    """Refuse request bodies over MAX_CONTENT_LENGTH before the upload is parsed."""
+    if (request.content_length or 0) > app.config['MAX_CONTENT_LENGTH']:
+        return ojsonify({
+            "error": "Upload too large",
+            "message": f"Please upload at most {MAX_UPLOAD_FILES} screenshots of up to 5MB each"
+        }, 413)
+
+
+# Connection pool settings shared by the sync and async Anthropic clients, so
+# warm requests reuse keep-alive HTTP/2 connections instead of new TLS handshakes.
+# The read timeout allows for a full non-streamed training plan.
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=64, max_connections=128)
+HTTP_TIMEOUT = httpx.Timeout(180.0, connect=5.0)
+
+
+def create_once(factory):
+    """Decorate a zero-argument factory so it runs on first call only, even across threads."""
+    cached = functools.lru_cache(maxsize=1)(factory)
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get():
+        with lock:
+            return cached()
+
+    return get
+
+
+# Clients are created on first use, so importing the app (worker start-up,
+# tooling) doesn't build HTTP pools or need ANTHROPIC_API_KEY
+@create_once
+def get_client():
+    """The shared Anthropic client."""
+    return Anthropic(
+        api_key=os.getenv("ANTHROPIC_API_KEY"),
+        http_client=httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    )
+
+
+# Maximum size of a single uploaded screenshot
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Maximum screenshots per request. Request bodies over the combined limit are
+# refused before the multipart body is parsed.
+MAX_UPLOAD_FILES = 50
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_FILES * MAX_IMAGE_BYTES
+
+# Output budget for the holistic analysis JSON, plus room for each run_by_run_notes entry.
+# Output latency is linear in generated tokens, so keep this tight.
+HOLISTIC_MAX_TOKENS = 2048
+HOLISTIC_MAX_TOKENS_PER_SCREENSHOT = 64
+
+# Uploads are read and hashed in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Claude downsamples images with a longer edge than this, so bigger uploads only cost bandwidth
+MAX_IMAGE_EDGE = 1568
+
+# JPEG EXIF lives in the file header; never scan further than this for it
+EXIF_SCAN_BYTES = 64 * 1024
+
+# PNG text chunk keyword ImageMagick and others use for hex-encoded EXIF, and a
+# cap on how far a compressed one is inflated
+PNG_EXIF_PROFILE_KEYWORD = b'Raw profile type exif'
+PNG_EXIF_PROFILE_MAX_BYTES = 1024 * 1024
+
+# EXIF tag ids for the capture time. DateTime lives in IFD0; the other two in the Exif sub-IFD.
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME = 0x0132
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_DATETIME_DIGITIZED = 0x9004
+
+# Media types for the image extensions Claude accepts
+MEDIA_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'gif': 'image/gif'
+}
+
+# Filename datetime fallback, matching "Screenshot 2024-01-15 at 10.30.45.png"
+# or "IMG_20240115_103045.jpg" in a single pass
+FILENAME_DATETIME_PATTERN = re.compile(
+    r'(?P<y1>\d{4})-(?P<mo1>\d{2})-(?P<d1>\d{2}).*?(?P<h1>\d{1,2})\.(?P<mi1>\d{2})\.(?P<s1>\d{2})'
+    r'|(?P<y2>\d{4})(?P<mo2>\d{2})(?P<d2>\d{2})_(?P<h2>\d{2})(?P<mi2>\d{2})(?P<s2>\d{2})'
+)
+SCREENSHOT_FILENAME_GROUPS = ('y1', 'mo1', 'd1', 'h1', 'mi1', 's1')
+CAMERA_FILENAME_GROUPS = ('y2', 'mo2', 'd2', 'h2', 'mi2', 's2')
+
+# Batch custom_ids must be 1-64 characters of letters, digits, '_' or '-'
+BATCH_SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Haiku reads numbers off individual screenshots; Sonnet does the coaching synthesis
+MODEL_EXTRACT = "claude-haiku-4-5"
+MODEL_COACH = "claude-sonnet-4-5"
+
+# Fraction of screenshot extractions to wait for before starting the Sonnet synthesis;
+# the rest keep running alongside it and are merged into its result
+EARLY_SYNTHESIS_FRACTION = 0.6
+
+# Parsed analyses keyed by screenshot hashes, so re-uploads skip the Claude calls
+analysis_cache = Cache(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".carv_cache"))
+ANALYSIS_CACHE_TTL = 24 * 60 * 60
+
+
+# Async client for concurrent per-screenshot calls. Flask views are synchronous,
+# so the async client lives on a dedicated background event loop.
+@create_once
+def get_async_client():
+    """The shared AsyncAnthropic client; only use it on the get_async_loop() loop."""
+    return AsyncAnthropic(
+        api_key=os.getenv("ANTHROPIC_API_KEY"),
+        http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    )
+
+
+@create_once
+def get_async_loop():
+    """The background event loop that runs the async client's calls, started on first use."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="anthropic-async", daemon=True).start()
+    return loop
+
+
+class FileTooLargeError(ValueError):
+    """Raised when an uploaded screenshot exceeds MAX_IMAGE_BYTES."""
+
+
+class LRUCache:
+    """Small thread-safe in-process LRU cache."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if absent."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache value under key, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+# Downscaled base64 screenshots keyed by SHA-256 of the upload, so retries and
+# repeat uploads skip the Pillow decode/resize/encode. ~400KB per entry.
+prepped_image_cache = LRUCache(maxsize=64)
+
+# In-process tier in front of analysis_cache, so repeat uploads to the same
+# worker skip the disk read and unpickle
+analysis_memory_cache = LRUCache(maxsize=128)
+
+# Training plan text keyed by the Claude request that produced it
+plan_cache = LRUCache(maxsize=128)
+
+
+# Prompt text lives in prompts/*.txt and is read once at import
+PROMPTS_DIR = Path(__file__).resolve().parent / "prompts"
+
+
+def load_prompt(name):
+    """Read a prompt from PROMPTS_DIR."""
+    return (PROMPTS_DIR / f"{name}.txt").read_text(encoding="utf-8")
+
+
+def compile_prompt(template):
+    """
+    Split a str.format-style prompt into (literal, field_name) parts once at import.
+
+    Rendering then only joins the literal pieces with the per-request values,
+    instead of re-parsing the whole multi-KB template on every call.
+    """
+    parts = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+        if format_spec or conversion:
+            raise ValueError(f"Prompt field {{{field_name}}} must not use a format spec or conversion")
+        parts.append((literal, field_name))
+    return tuple(parts)
+
+
+def render_prompt(parts, **values):
+    """Fill a compiled prompt's fields with values."""
+    pieces = []
+    for literal, field_name in parts:
+        pieces.append(literal)
+        if field_name is not None:
+            pieces.append(str(values[field_name]))
+    return "".join(pieces)
+
 
 # CARV Metrics Context for AI Analysis - Comprehensive Carving Knowledge Base
-CARV_METRICS_CONTEXT = """
-You are an elite ski coach and CARV technology expert with deep knowledge of carving biomechanics.
-Your analysis is based on proven carving principles, not generic skiing advice.
-
-## CORE CARVING PHILOSOPHY
-
-A carved turn is when the ski tail follows the exact arc created by the ski tip - like a train on tracks.
-The ski's sidecut does the turning work when the ski is tipped on edge and pressured correctly.
-
-### The Physics of Carving
-- **Sidecut Geometry**: When a ski is tilted on edge, its curved shape creates an arc
-- **Pressure + Edge Angle = Turn Radius**: More edge angle = tighter turn
-- **Clean Edge Lock**: A true carve leaves a single thin line in the snow, not a smeared path
-- **G-Forces**: Generated from the ski's grip fighting centrifugal force - a byproduct of technique, not the goal
-
-### The 4 Pillars of Expert Carving
-1. **Edge Angle** - How far you tip the ski (measured in degrees)
-2. **Fore/Aft Balance** - Weight distribution along the ski length
-3. **Rotary Control** - Hip and shoulder alignment relative to skis
-4. **Pressure Management** - How and when you load/unload the ski
-
-## CARV METRICS - DEEP INTERPRETATION
-
-### Ski:IQ Score (Overall Performance)
-- 100 = Average recreational skier
-- 100-115 = Intermediate - developing skills
-- 115-125 = Advanced intermediate - linking carved turns
-- 125-140 = Advanced - consistent carving on varied terrain
-- 140-155 = Expert - high edge angles, dynamic skiing
-- 155+ = Elite - race-level technique
-
-### BALANCE CATEGORY (Critical for Carving)
-
-**1. Start of Turn (Forward Pressure)** - Score 0-100
-- WHAT IT MEASURES: Weight shift to ski tips at turn initiation
-- WHY IT MATTERS: Forward pressure engages the front of the ski first, creating early edge grip
-- LOW SCORE INDICATES:
-  * Sitting back in the boots (common fear response)
-  * Late turn initiation
-  * Skis running away at start of turn
-- BIOMECHANICS: Shin pressure against boot tongue, hips forward over toes
-- TARGET FEELING: "Driving the front of the ski into the turn"
-
-**2. Centered Balance** - Score 0-100
-- WHAT IT MEASURES: Maintaining balance over the center of the ski during the turn
-- WHY IT MATTERS: Centered stance allows the whole ski edge to engage
-- LOW SCORE INDICATES:
-  * Getting pulled into the backseat mid-turn
-  * Upper body leaning uphill (defensive posture)
-  * Weak core engagement
-- BIOMECHANICS: Ankle flexion, knee drive, hips stacked over feet
-- TARGET FEELING: "Balanced over the arch of the foot"
-
-**3. Transition Weight Release** - Score 0-100
-- WHAT IT MEASURES: How cleanly you release the old outside ski to start the new turn
-- WHY IT MATTERS: Clean release allows quick edge change and early new edge engagement
-- LOW SCORE INDICATES:
-  * Hanging onto the old turn too long
-  * Hesitation in transition (fear of commitment)
-  * Not trusting the new outside ski
-- BIOMECHANICS: Active retraction/extension, positive move down the hill
-- TARGET FEELING: "Light feet between turns" / "Floating through transition"
-
-### EDGING CATEGORY (The Heart of Carving)
-
-**1. Edge Angle** - Score 0-100 or degrees
-- WHAT IT MEASURES: Maximum angle of ski edge relative to snow
-- WHY IT MATTERS: Higher edge angles = tighter turn radius, more grip
-- SCORE INTERPRETATION:
-  * 30-40°: Recreational carving
-  * 45-55°: Strong intermediate carving
-  * 55-65°: Advanced/expert carving
-  * 65°+: Elite/racing level
-- LOW SCORE INDICATES:
-  * Fear of commitment
-  * Lack of hip angulation
-  * Upper body not countering
-- BIOMECHANICS: Knee drive into the hill, hip angulation, outside arm forward
-
-**2. Early Edging** - Score 0-100
-- WHAT IT MEASURES: How quickly you establish edge grip after transition
-- WHY IT MATTERS: Early edge = early grip = controlled arc from the start
-- LOW SCORE INDICATES:
-  * Pivoting/skidding the ski flat before tipping
-  * Delayed weight transfer to new outside ski
-  * Sequential movements instead of simultaneous
-- BIOMECHANICS: Roll ankles and knees into new turn immediately
-- TARGET FEELING: "Tip and grip" / "Edge before you steer"
-
-**3. Edging Similarity** - Score 0-100
-- WHAT IT MEASURES: Consistency between left and right turns
-- WHY IT MATTERS: Asymmetry limits overall skiing and creates fatigue
-- LOW SCORE INDICATES:
-  * Dominant side/weaker side
-  * Historical injury compensation
-  * Equipment issues (boot cant, binding mount)
-- COMMON PATTERNS:
-  * Stronger toeside vs heelside (or vice versa)
-  * One hip less mobile than the other
-
-**4. Progressive Edge Build** - Score 0-100
-- WHAT IT MEASURES: Whether edge angle increases throughout the turn
-- WHY IT MATTERS: Shows controlled, confident carving vs "park and ride"
-- LOW SCORE INDICATES:
-  * "Setting an edge and holding" instead of building
-  * Fear of increasing commitment
-  * Lack of dynamic range
-- BIOMECHANICS: Continuous hip/knee drive through the turn arc
-- TARGET FEELING: "Squeezing the orange through the turn"
-
-### ROTARY CATEGORY
-
-**1. Parallel Skis** - Score 0-100
-- WHAT IT MEASURES: How parallel the skis remain throughout turns
-- WHY IT MATTERS: Parallel skis = both skis carving similar arcs
-- LOW SCORE INDICATES:
-  * Stemming or wedging (using inside ski for braking)
-  * A-frame stance (knees together, skis apart)
-  * Inside ski not tipping enough
-- BIOMECHANICS: Both legs work together, inside ski leads slightly
-- TARGET FEELING: "Railroad tracks in the snow"
-
-**2. Turn Shape** - Score 0-100
-- WHAT IT MEASURES: Smooth C-shaped arcs vs Z-shaped jerky turns
-- WHY IT MATTERS: Smooth arcs = continuous edge engagement, controlled speed
-- LOW SCORE INDICATES:
-  * Pivot-based turning (rotate, skid, set edge)
-  * Speed check at end of turn
-  * Lack of patience through the arc
-- BIOMECHANICS: Continuous flow, no abrupt movements
-- TARGET FEELING: "Paint a smooth arc in the snow"
-
-### PERFORMANCE CATEGORY
-
-**1. Turn G-Force** - Score 0-100 or actual G value
-- WHAT IT MEASURES: Forces generated during turns
-- WHY IT MATTERS: High G-force = strong edge grip and athletic skiing
-- CONTEXT: G-force is a RESULT of good technique, not a goal
-  * 1.5-2.0G: Recreational carving
-  * 2.0-2.5G: Strong carving
-  * 2.5-3.0G: Expert/racing
-  * 3.0G+: Elite racing level
-- LOW SCORE WITH HIGH EDGE ANGLE: May indicate skidding despite tipping
-- HIGH SCORE: Shows the ski is truly gripping and bending
-
-## DIAGNOSTIC FRAMEWORK - SYMPTOM TO ROOT CAUSE
-
-### Low Start of Turn Score
-ROOT CAUSES:
-1. Fear of speed/falling - creates defensive backseat posture
-2. Weak ankle flex - can't drive shins into boot tongue
-3. Hip mobility issues - can't flex at hip to stay forward
-4. Boot setup - too much forward lean or ramp angle
-CASCADING EFFECTS: Late edge engagement, skis run away, loss of control
-
-### Low Edge Angle Score
-ROOT CAUSES:
-1. Fear of commitment - scared to tip fully
-2. Lack of hip angulation - using only knee inclination
-3. Upper body rotation - shoulders following skis instead of countering
-4. Inside ski dominance - weighting inside ski prevents outside ski tipping
-CASCADING EFFECTS: Skidding instead of carving, speed control issues
-
-### Low Early Edging Score
-ROOT CAUSES:
-1. Pivot habit - rotating ski flat before tipping
-2. Slow weight transfer - hesitation to commit to new outside ski
-3. Sequential movement pattern - one thing at a time instead of simultaneous
-CASCADING EFFECTS: Skidded entry, delayed grip, inconsistent turns
-
-### Low Transition Weight Release Score
-ROOT CAUSES:
-1. Fear of the fall line - not trusting the new turn
-2. Z-turn habit - finishing turn hard, then flat, then next turn
-3. Lack of extension/retraction - static body position
-CASCADING EFFECTS: Choppy transitions, loss of flow, fatigue
-
-### Low Centered Balance Score
-ROOT CAUSES:
-1. Getting pulled back by G-forces - not anticipating the load
-2. Upper body leaning uphill - defensive "survival" stance
-3. Weak core - can't maintain position under load
-CASCADING EFFECTS: Loss of ski control in bottom half of turn
-
-### Low Progressive Edge Build Score
-ROOT CAUSES:
-1. "Park and ride" habit - set edge angle and hold
-2. Fear of increasing commitment - playing it safe
-3. Lack of dynamic range - don't know how to increase through turn
-CASCADING EFFECTS: Predictable skiing, limited ability on varied terrain
-
-## SKILL PROGRESSION LEVELS
-
-### ENTRY LEVEL (Ski:IQ 100-115)
-- Focus: Basic carved turns on easy terrain
-- Key Skills: Edge awareness, balance drills, smooth transitions
-- Terrain: Green/easy blue, well-groomed
-- Goals: Feel the difference between skidding and carving
-
-### DEVELOPMENT LEVEL (Ski:IQ 115-125)
-- Focus: Consistent carving, building edge angles
-- Key Skills: Hip angulation, pole timing, variable turn radius
-- Terrain: Blue runs, moderate pitch
-- Goals: Leave clean pencil lines in the snow
-
-### PERFORMANCE LEVEL (Ski:IQ 125-140)
-- Focus: Dynamic skiing, terrain adaptation
-- Key Skills: Pressure management, flexion/extension, aggressive transitions
-- Terrain: All blues, black runs
-- Goals: Maintain technique under speed and variable conditions
-
-### HIGH PERFORMANCE (Ski:IQ 140+)
-- Focus: Racing technique, extreme edge angles
-- Key Skills: Carving on steep terrain, gates, high-speed stability
-- Terrain: Black/double-black, race courses
-- Goals: Elite-level edge angles, consistent G-forces
-
-## TERRAIN & CONDITIONS CONTEXT
-
-### Groomed Runs
-- Ideal for technique work
-- Edge grip is predictable
-- Focus: Clean carving mechanics
-
-### Steep Terrain
-- Tests commitment and balance
-- Requires earlier edge engagement
-- Focus: Forward pressure, aggressive pole plant
-
-### Variable Snow
-- Requires adaptive pressure management
-- Edge angle less critical than balance
-- Focus: Quiet upper body, reactive legs
-
-### Ice/Hard Pack
-- Demands precise edge control
-- Slight detuning may help
-- Focus: Very clean technique, no skidding allowed
-"""
+CARV_METRICS_CONTEXT = load_prompt("carv_metrics_context")
+
+# Per-screenshot extraction prompt (one call per uploaded image)
+IMAGE_EXTRACTION_PROMPT = compile_prompt(load_prompt("image_extraction"))
+
+# Hands the aggregated per-screenshot extractions to the holistic analysis call
+SCREENSHOT_EXTRACTIONS_PREAMBLE = compile_prompt(load_prompt("screenshot_extractions_preamble"))
+
+# Metric keys reported by CARV, grouped as in the analysis response
+METRIC_CATEGORIES = {
+    "balance": ("start_of_turn", "centered_balance", "transition_weight_release"),
+    "edging": ("edge_angle", "early_edging", "edging_similarity", "progressive_edge_build"),
+    "rotary": ("parallel_skis", "turn_shape"),
+    "performance": ("turn_g_force",)
+}
+
+
+def nullable_number(description):
+    """JSON Schema for a number the model may not be able to read."""
+    return {"type": ["number", "null"], "description": description}
+
+
+def nullable_string(description):
+    """JSON Schema for a string the model may not be able to read."""
+    return {"type": ["string", "null"], "description": description}
+
+
+def text_field(description):
+    """JSON Schema for a required free-text field."""
+    return {"type": "string", "description": description}
+
+
+def object_schema(properties):
+    """JSON Schema for an object whose properties are all required."""
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+# Forced tool call that returns the holistic analysis as structured input, so the
+# response never needs JSON cleanup or a retry
+RECORD_ANALYSIS_TOOL = {
+    "name": "record_analysis",
+    "description": "Record the holistic analysis of the skier's CARV session.",
+    "input_schema": object_schema({
+        "session_overview": object_schema({
+            "total_screenshots": {"type": "integer"},
+            "session_datetime": nullable_string(
+                "Date and time shown on the CARV screenshot in ISO format YYYY-MM-DDTHH:MM:SS, "
+                "e.g. 2024-01-15T10:30:00. If multiple dates are visible, use the most recent. "
+                "null if no date is visible"
+            ),
+            "session_date_display": nullable_string(
+                "The date/time as shown on screen, e.g. 'Jan 15, 2024 10:30 AM'. null if not visible"
+            ),
+            "ski_iq_range": object_schema({
+                "lowest": nullable_number("Lowest Ski:IQ seen"),
+                "highest": nullable_number("Highest Ski:IQ seen"),
+                "average": nullable_number("Average Ski:IQ")
+            }),
+            "terrain_types_seen": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "Terrain types visible across all screenshots"
+            },
+            "total_turns_analyzed": nullable_number("Sum of turns if visible")
+        }),
+        "overall_metrics": object_schema({
+            category: object_schema({
+                **{name: nullable_number("Average score 0-100") for name in metric_names},
+                "category_average": nullable_number(f"Average of all {category} metrics")
+            })
+            for category, metric_names in METRIC_CATEGORIES.items()
+        }),
+        "holistic_analysis": object_schema({
+            "skiing_style": text_field(
+                "Their overall skiing style based on all data - aggressive, cautious, dynamic, static, etc."
+            ),
+            "technique_signature": text_field("What makes this skier unique - their characteristic patterns"),
+            "consistency_assessment": text_field(
+                "How consistent they are across runs/metrics - very consistent, variable, improving, etc."
+            ),
+            "biggest_limiter": text_field("The ONE thing most holding back their skiing"),
+            "hidden_strength": text_field("A strength they might not realize they have")
+        }),
+        "detailed_observations": text_field(
+            "Comprehensive analysis of what you see across ALL screenshots - "
+            "be specific about patterns, trends, and notable findings"
+        ),
+        "top_3_strengths": {
+            "type": "array",
+            "maxItems": 3,
+            "items": object_schema({
+                "area": text_field("Metric or skill name"),
+                "score": nullable_number("Average score if applicable"),
+                "why_it_matters": text_field("Brief explanation of why this helps their skiing")
+            })
+        },
+        "top_3_priorities": {
+            "type": "array",
+            "maxItems": 3,
+            "items": object_schema({
+                "area": text_field("Metric or skill name"),
+                "current_score": nullable_number("Average score if applicable"),
+                "target_score": nullable_number("Realistic target"),
+                "why_priority": text_field("Why this should be focus #1, #2, or #3"),
+                "quick_win": text_field("One simple thing to try")
+            })
+        },
+        "run_by_run_notes": {
+            "type": "array",
+            "items": object_schema({
+                "screenshot": {"type": "integer", "description": "1, 2, 3, etc."},
+                "key_observation": text_field("What stands out in this particular screenshot")
+            })
+        }
+    })
+}
+
+# Part of the analysis cache key - bump whenever the analysis prompts or models change
+PROMPT_VERSION = "3"
 
 # Holistic multi-image analysis prompt
-HOLISTIC_ANALYSIS_PROMPT = """
-You are analyzing {num_images} CARV app screenshots from a skier's session. Look at ALL the images together to get a complete picture of their skiing performance.
-
-## YOUR DIAGNOSTIC APPROACH
-
-Use this framework to identify ROOT CAUSES, not just symptoms:
-
-**Low Start of Turn** → Root causes: Fear (backseat), weak ankle flex, hip mobility, boot setup
-**Low Centered Balance** → Root causes: G-force pulling back, defensive uphill lean, weak core
-**Low Weight Release** → Root causes: Fear of fall line, Z-turn habit, static body
-**Low Edge Angle** → Root causes: Fear of commitment, no hip angulation, upper body rotation
-**Low Early Edging** → Root causes: Pivot habit, slow weight transfer, sequential movements
-**Low Edging Similarity** → Root causes: Dominant side, injury compensation, equipment
-**Low Progressive Edge Build** → Root causes: "Park and ride" habit, fear, limited dynamic range
-**Low Parallel Skis** → Root causes: Stemming, A-frame, inside ski not tipping
-**Low Turn Shape** → Root causes: Pivot-based turning, speed checking, impatience
-**Low G-Force with good edges** → Skidding despite tipping - technique breakdown
-
-Analyze these screenshots HOLISTICALLY - treat them as different views of the same ski session or related sessions. Look for:
-- Overall patterns across all screenshots
-- Consistent strengths and weaknesses
-- ROOT CAUSES of issues, not just symptoms
-- Any progression or variation between runs
-- The complete picture of this skier's technique
-
-IMPORTANT: Extract the date and time displayed on the CARV app screenshots. Look for the date/time shown near the Ski:IQ score or in the run header. This is the MASTER timestamp for the session.
-
-Return a JSON object with this EXACT structure:
-
-{{
-  "session_overview": {{
-    "total_screenshots": {num_images},
-    "session_datetime": "<date and time shown on the CARV screenshot in ISO format YYYY-MM-DDTHH:MM:SS, e.g., 2024-01-15T10:30:00. Extract from the screenshot display. If multiple dates visible, use the most recent. If no date visible, use null>",
-    "session_date_display": "<the date/time as shown on screen, e.g., 'Jan 15, 2024 10:30 AM' or whatever format is displayed. null if not visible>",
-    "ski_iq_range": {{
-      "lowest": <number or null>,
-      "highest": <number or null>,
-      "average": <number or null>
-    }},
-    "terrain_types_seen": ["<list of terrain types visible across all screenshots>"],
-    "total_turns_analyzed": <sum of turns if visible, or null>
-  }},
-  "overall_metrics": {{
-    "balance": {{
-      "start_of_turn": <average score 0-100 or null>,
-      "centered_balance": <average score 0-100 or null>,
-      "transition_weight_release": <average score 0-100 or null>,
-      "category_average": <average of all balance metrics>
-    }},
-    "edging": {{
-      "edge_angle": <average score 0-100 or null>,
-      "early_edging": <average score 0-100 or null>,
-      "edging_similarity": <average score 0-100 or null>,
-      "progressive_edge_build": <average score 0-100 or null>,
-      "category_average": <average of all edging metrics>
-    }},
-    "rotary": {{
-      "parallel_skis": <average score 0-100 or null>,
-      "turn_shape": <average score 0-100 or null>,
-      "category_average": <average of all rotary metrics>
-    }},
-    "performance": {{
-      "turn_g_force": <average score 0-100 or null>,
-      "category_average": <same as turn_g_force>
-    }}
-  }},
-  "holistic_analysis": {{
-    "skiing_style": "<describe their overall skiing style based on all data - are they aggressive, cautious, dynamic, static, etc.>",
-    "technique_signature": "<what makes this skier unique - their characteristic patterns>",
-    "consistency_assessment": "<how consistent are they across runs/metrics - very consistent, variable, improving, etc.>",
-    "biggest_limiter": "<the ONE thing most holding back their skiing>",
-    "hidden_strength": "<a strength they might not realize they have>"
-  }},
-  "detailed_observations": "<comprehensive analysis of what you see across ALL screenshots - be specific about patterns, trends, and notable findings>",
-  "top_3_strengths": [
-    {{
-      "area": "<metric or skill name>",
-      "score": <average score if applicable>,
-      "why_it_matters": "<brief explanation of why this helps their skiing>"
-    }}
-  ],
-  "top_3_priorities": [
-    {{
-      "area": "<metric or skill name>",
-      "current_score": <average score if applicable>,
-      "target_score": <realistic target>,
-      "why_priority": "<why this should be focus #1, #2, or #3>",
-      "quick_win": "<one simple thing to try>"
-    }}
-  ],
-  "run_by_run_notes": [
-    {{
-      "screenshot": <1, 2, 3, etc.>,
-      "key_observation": "<what stands out in this particular screenshot>"
-    }}
-  ]
-}}
-
-CRITICAL INSTRUCTIONS:
-1. Return ONLY valid JSON - no markdown, no explanations before or after
-2. Look at ALL images before forming conclusions
-3. Average metrics where you see the same metric in multiple screenshots
-4. If a metric appears in only some screenshots, still include it
-5. Be specific and actionable in your analysis
-6. The "biggest_limiter" should be the #1 thing to work on
-7. Consider how different screenshots might show different aspects of the same session
-"""
+HOLISTIC_ANALYSIS_PROMPT = compile_prompt(load_prompt("holistic_analysis"))
+
+TRAINING_PLAN_PROMPT = compile_prompt(load_prompt("training_plan"))
+
+# System prompt for training plan generation. The drill library is static, so it
+# lives here rather than in the per-request prompt: together they clear the
+# minimum cacheable prompt length and are served from the prompt cache.
+TRAINING_COACH_SYSTEM_PROMPT = load_prompt("training_coach_system") + "\n\n" + load_prompt("drill_library")
+
+
+def cached_system_prompt(text, ttl=None):
+    """
+    Wrap a static system prompt in a content block marked for prompt caching.
+
+    Anthropic serves repeated prefixes from its prompt cache, so the large
+    coaching context is only billed at full price on the first request.
+    Pass ttl="1h" for long-running batch work; the default TTL is 5 minutes.
+    """
+    cache_control = {"type": "ephemeral"}
+    if ttl:
+        cache_control["ttl"] = ttl
+    return [{"type": "text", "text": text, "cache_control": cache_control}]
 
-TRAINING_PLAN_PROMPT = """
-Based on this COMPREHENSIVE CARV skiing analysis from multiple screenshots, create a personalized training plan.
-
-ANALYSIS DATA:
-{analysis_data}
-
-This analysis represents data from {num_runs} screenshot(s) giving us a complete picture of this skier.
-
-## DRILL LIBRARY - SELECT APPROPRIATE DRILLS BASED ON ISSUES IDENTIFIED
-
-### FOUNDATION DRILLS (Building Blocks)
-
-**1. Thousand Steps**
-- Purpose: Develops balance, weight transfer awareness, edge feel
-- Execution: Make tiny rapid steps from ski to ski while traversing/turning
-- Feel: Dancing on the snow, constant weight shifting
-- Duration: 2-3 runs, green/easy blue terrain
-- Improves: Centered Balance, Weight Release, Edging Similarity
-- Common Mistake: Steps too big - keep them small and quick
-
-**2. Javelin Turns**
-- Purpose: Forces commitment to outside ski, eliminates inside ski dependency
-- Execution: Lift inside ski completely off snow, hold parallel to outside ski during turn
-- Feel: All weight on one ski, total commitment
-- Duration: 5-8 turns each side, moderate blue terrain
-- Improves: Edge Angle, Start of Turn, Centered Balance
-- Common Mistake: Leaning into hill for balance instead of angulating
-
-**3. Shuffle Turns**
-- Purpose: Develops independent leg action and balance
-- Execution: Slide inside foot forward, outside foot back during turns
-- Feel: Scissors motion, dynamic leg independence
-- Duration: Full run, green terrain
-- Improves: Parallel Skis, Turn Shape, balance awareness
-
-**4. Pivot Slips**
-- Purpose: Develops rotary control and edge release ability
-- Execution: From standstill, release edges and pivot 180°, then stop
-- Feel: Controlled sliding, precise edge control
-- Duration: 10 pivots each direction
-- Improves: Transition Weight Release, edge awareness
-
-### EDGE ANGLE DEVELOPMENT DRILLS
-
-**5. Railroad Track Carving**
-- Purpose: Develops pure carving - no skidding
-- Execution: Make turns leaving only two clean pencil lines in snow
-- Feel: Train on tracks, no sideways sliding
-- Duration: Full runs, focus on quality not quantity
-- Improves: Edge Angle, Turn Shape, Progressive Edge Build
-- Common Mistake: Going too fast - start slow, prioritize clean tracks
-
-**6. J-Turns (Edge Lock Drill)**
-- Purpose: Maximizes edge angle commitment
-- Execution: From traverse, commit to fall line, carve hard uphill until stop
-- Feel: Maximum edge engagement, G-force building, ski bending
-- Duration: 5 each direction, moderate pitch
-- Improves: Edge Angle, Progressive Edge Build, commitment
-
-**7. Angulation Exaggeration**
-- Purpose: Develops hip angulation for higher edge angles
-- Execution: Touch outside hand to outside boot during turns
-- Feel: Body folding at waist, hips pushing into hill
-- Duration: 4-6 turns each direction
-- Improves: Edge Angle, Centered Balance
-- Common Mistake: Bending at waist instead of creating hip angle
-
-**8. Pole Drag Carving**
-- Purpose: Forces upper body countering and angulation
-- Execution: Drag inside pole tip in snow throughout turn
-- Feel: Upper body stays facing downhill, separation from lower body
-- Duration: Full run
-- Improves: Edge Angle, Turn Shape, upper/lower body separation
-
-### BALANCE & FORE-AFT DRILLS
-
-**9. Shin Banger**
-- Purpose: Develops forward pressure and ankle flex
-- Execution: Feel constant shin pressure on boot tongue throughout turn
-- Feel: Shins pressing forward, never losing contact
-- Duration: Every turn, conscious focus
-- Improves: Start of Turn, Centered Balance
-- Cue: "Crush the tongue"
-
-**10. Hands on Knees Turns**
-- Purpose: Forces forward stance and commitment
-- Execution: Ski with hands resting on kneecaps
-- Feel: Stacked, forward, can't sit back
-- Duration: 4-6 turns, easy terrain
-- Improves: Start of Turn, Centered Balance
-- Common Mistake: Bending too much at waist
-
-**11. Tall-Small Transitions**
-- Purpose: Develops extension/flexion timing
-- Execution: Extend tall at turn finish, flex small at turn apex
-- Feel: Up-down rhythm, dynamic range of motion
-- Duration: Full run, exaggerate movement
-- Improves: Transition Weight Release, Pressure Management
-
-**12. Touch the Outside Boot**
-- Purpose: Develops outside ski pressure and forward commitment
-- Execution: Reach down and touch outside boot at turn apex
-- Feel: Weight over outside ski, forward and low
-- Duration: Alternating turns
-- Improves: Start of Turn, Centered Balance, Edge Angle
-
-### TRANSITION & FLOW DRILLS
-
-**13. White Pass Turns**
-- Purpose: Develops early weight transfer and commitment to new turn
-- Execution: Transfer weight to new ski BEFORE releasing old turn
-- Feel: New turn starts before old one ends, overlapping commitment
-- Duration: Focus drill, 6-8 turns
-- Improves: Transition Weight Release, Early Edging
-- Common Mistake: Finishing old turn completely before starting new
-
-**14. Crossover Focus**
-- Purpose: Develops positive movement into new turn
-- Execution: Feel center of mass crossing over skis into new turn
-- Feel: Body moving downhill into the new arc, not pulling back
-- Duration: Every transition, conscious awareness
-- Improves: Transition Weight Release, Early Edging
-- Cue: "Fall into the new turn"
-
-**15. No Pole Skiing**
-- Purpose: Develops balance without pole crutch
-- Execution: Remove poles, hands on hips or crossed on chest
-- Feel: Pure balance, can't push off anything
-- Duration: Full runs
-- Improves: Centered Balance, Core engagement
-
-**16. Patience Turns**
-- Purpose: Develops complete turn finish and clean transitions
-- Execution: Let each turn finish completely up the hill before transitioning
-- Feel: No rushing, complete the arc
-- Duration: Focus on slow rhythmic skiing
-- Improves: Turn Shape, Transition Weight Release
-
-### ADVANCED PERFORMANCE DRILLS
-
-**17. Retraction Turns**
-- Purpose: Develops quick edge-to-edge transitions
-- Execution: Pull feet up under body at transition, extend into new turn
-- Feel: Light feet at crossover, snappy transition
-- Duration: Moderate to steep terrain
-- Improves: Transition Weight Release, Early Edging, G-Force
-
-**18. Dolphin Turns**
-- Purpose: Develops pressure modulation and dynamic range
-- Execution: Flex deep into turn apex, extend through transition
-- Feel: Wave-like body motion, pressure on-off-on
-- Duration: Full runs, flowing terrain
-- Improves: Progressive Edge Build, Turn G-Force, Pressure Management
-
-**19. Speed Carving**
-- Purpose: Develops trust in edge grip at speed
-- Execution: Increase speed while maintaining pure carved turns
-- Feel: Acceleration through the arc, G-forces building
-- Duration: Open blue/black runs
-- Improves: Edge Angle, Turn G-Force, confidence
-
-**20. Variable Radius Carving**
-- Purpose: Develops ability to adjust turn shape
-- Execution: Alternate between long radius and short radius carved turns
-- Feel: Adjustable pressure/edge, ski bending different amounts
-- Duration: Full runs
-- Improves: Progressive Edge Build, Turn Shape, versatility
-
-### HIGH-PERFORMANCE DRILLS
-
-**21. Hop Transitions**
-- Purpose: Develops explosive edge change
-- Execution: Hop both skis off snow at transition, land on new edges
-- Feel: Explosive, athletic, immediate edge engagement
-- Duration: Steep terrain, short sections
-- Improves: Early Edging, Transition Weight Release, athleticism
-
-**22. One-Ski Carving**
-- Purpose: Ultimate balance and edge control test
-- Execution: Remove one ski, carve turns on single ski
-- Feel: Total commitment, no backup
-- Duration: Easy terrain, 3-4 turns per side
-- Improves: Edge Angle, Centered Balance, balance mastery
-
-**23. Gate Training Simulation**
-- Purpose: Develops race-timing and line
-- Execution: Visualize gates, commit to apex, accelerate out
-- Feel: Early pressure, round the gate, explode out
-- Duration: Open slope, mark mental gates
-- Improves: All metrics, race application
-
-## DRILL SELECTION FRAMEWORK
-
-Based on the skier's profile, select drills using this logic:
-
-**For Low START OF TURN scores**: Shin Banger, Hands on Knees, Touch Outside Boot
-**For Low CENTERED BALANCE scores**: Javelin Turns, Thousand Steps, No Pole Skiing
-**For Low TRANSITION WEIGHT RELEASE scores**: White Pass Turns, Crossover Focus, Tall-Small
-**For Low EDGE ANGLE scores**: J-Turns, Angulation Exaggeration, Pole Drag Carving
-**For Low EARLY EDGING scores**: White Pass Turns, Retraction Turns, Hop Transitions
-**For Low EDGING SIMILARITY scores**: Thousand Steps, One-Ski Carving, Javelin Turns (weak side focus)
-**For Low PROGRESSIVE EDGE BUILD scores**: J-Turns, Dolphin Turns, Railroad Track Carving
-**For Low PARALLEL SKIS scores**: Shuffle Turns, Thousand Steps
-**For Low TURN SHAPE scores**: Patience Turns, Railroad Track Carving, Variable Radius
-**For Low G-FORCE with good edge angles**: Speed Carving, Dolphin Turns (indicates skidding despite tipping)
-
-## SESSION STRUCTURE RECOMMENDATIONS
-
-**Warm-up Phase (First 2-3 runs)**
-- Free skiing at 70% effort
-- One foundation drill (Thousand Steps or Shuffle Turns)
-- Activate key movement patterns
-
-**Focus Phase (4-6 runs)**
-- Primary improvement drill (selected for biggest limiter)
-- 3-4 focused turns, then free skiing
-- Rest between attempts
-
-**Integration Phase (2-3 runs)**
-- Free skiing incorporating new feel
-- Higher speed/steeper terrain
-- Don't think, just ski with new patterns
-
-**Cool-down (Final run)**
-- Free skiing, enjoyment focus
-- Notice what felt different today
-
----
-
-Based on this skier's analysis, create a plan following this structure:
-
-# Training Plan for Ski:IQ {ski_iq}
-
-## The Big Picture
-- Summarize this skier in 2-3 sentences based on the holistic analysis
-- Their current progression level (Entry/Development/Performance/High Performance)
-- The ONE biggest limiter holding them back
-
-## Immediate Focus (Next 1-3 Runs)
-Based on their BIGGEST LIMITER:
-- The primary issue to address
-- The single best drill from the library above
-- Detailed execution instructions
-- What success feels like
-- Mental cue (3-5 words)
-
-## Your 3 Key Drills
-
-YOU MUST INCLUDE EXACTLY 3 DRILLS with full details. Select from the Drill Library above based on their weakest metrics.
-
-### Drill 1: [Name] - Primary Focus
-- **Target Metric**: [The CARV metric this improves]
-- **Why This Drill**: [How it addresses their specific weakness]
-- **Execution**: [Step-by-step how to perform it]
-- **Runs Per Session**: [X runs] (e.g., 3-4 runs)
-- **Turns Per Run**: [X focused turns, then free ski]
-- **Terrain**: [Green/Blue/Black, groomed, pitch]
-- **Success Feels Like**: [Physical sensation when doing it right]
-- **Common Mistake**: [What to watch out for]
-- **Progression**: [How to make it harder as they improve]
-
-### Drill 2: [Name] - Secondary Focus
-- **Target Metric**: [The CARV metric this improves]
-- **Why This Drill**: [How it addresses their specific weakness]
-- **Execution**: [Step-by-step how to perform it]
-- **Runs Per Session**: [X runs]
-- **Turns Per Run**: [X focused turns, then free ski]
-- **Terrain**: [Recommendation]
-- **Success Feels Like**: [Physical sensation]
-- **Common Mistake**: [What to watch out for]
-
-### Drill 3: [Name] - Integration/Refinement
-- **Target Metric**: [The CARV metric this improves]
-- **Why This Drill**: [How it ties everything together]
-- **Execution**: [Step-by-step how to perform it]
-- **Runs Per Session**: [X runs]
-- **Turns Per Run**: [X focused turns, then free ski]
-- **Terrain**: [Recommendation]
-- **Success Feels Like**: [Physical sensation]
-
-## Daily Session Plan (10 Runs)
-
-Structure each ski day like this:
-
-**Run 1-2: Warm-Up Phase**
-- Free skiing at 70% effort
-- Focus: Get loose, feel the snow
-- Optional: Thousand Steps or Shuffle Turns to activate
-
-**Run 3-4: Drill 1 - [Name]**
-- [X] focused turns, then free ski to bottom
-- Rest at bottom, think about the feel
-- Repeat with intention
-
-**Run 5-6: Drill 2 - [Name]**
-- [X] focused turns, then free ski
-- Connect the feeling to Drill 1
-
-**Run 7-8: Drill 3 - [Name]**
-- [X] focused turns, then free ski
-- Integrate all three concepts
-
-**Run 9: Integration Run**
-- Free skiing at 80% effort
-- Apply all three drill concepts naturally
-- Don't think, just feel
-
-**Run 10: Fun Run**
-- Pure enjoyment skiing
-- Notice what feels different
-- End on a high note
-
-## Weekly Training Schedule
-
-### Day 1: Foundation Day
-- **Primary Focus**: Drill 1 (4 runs)
-- **Secondary**: Drill 2 (2 runs)
-- **Terrain**: Easier runs, perfect technique
-- **Goal**: Establish the movement patterns
-
-### Day 2: Development Day
-- **Primary Focus**: Drill 2 (4 runs)
-- **Secondary**: Drill 1 review (2 runs)
-- **Add**: Drill 3 introduction (2 runs)
-- **Terrain**: Progress to moderate terrain
-- **Goal**: Build on Day 1, add complexity
-
-### Day 3: Integration Day
-- **Primary Focus**: All 3 drills equally (2 runs each)
-- **Integration runs**: 4 runs applying concepts
-- **Terrain**: Varied - test on different pitches
-- **Goal**: Connect everything, build confidence
-
-### Day 4: Challenge Day
-- **Warm-up**: Quick drill review (1 run each)
-- **Challenge**: Apply to steeper/faster terrain
-- **Focus**: Maintain technique under pressure
-- **Goal**: Test limits, find new baseline
-
-### Day 5: Recovery & Assessment
-- **Light Focus**: Favorite drill only (2-3 runs)
-- **Mostly**: Free skiing with awareness
-- **End**: Take CARV screenshots for comparison
-- **Goal**: Consolidate gains, measure progress
-
-## This Week's Priorities
-
-### Priority 1: [Biggest Limiter]
-- Current: [score] → Target: [realistic target]
-- Primary Drill: Drill 1
-- Runs needed: 15-20 runs this week
-- Expected improvement: +5-8 points
-
-### Priority 2: [Second Issue]
-- Current: [score] → Target: [target]
-- Primary Drill: Drill 2
-- Runs needed: 10-15 runs this week
-- How it connects to Priority 1
-
-### Priority 3: [Third Issue]
-- Current: [score] → Target: [target]
-- Primary Drill: Drill 3
-- Runs needed: 8-10 runs this week
-- Integration with other priorities
-
-## Building on Strengths
-How to use their top strengths to accelerate improvement:
-- [Strength 1]: How it helps with [specific weakness]
-- [Strength 2]: How to leverage it
-
-## 4-Week Progression
-
-### Week 1-2: Foundation Building
-- Focus: [Primary limiter]
-- Drills: All 3 as described above
-- Drill Runs: 60% Drill 1, 30% Drill 2, 10% Drill 3
-- Target Metrics: [What CARV scores to watch]
-- Signs of Progress: [What they'll feel/see]
-
-### Week 3-4: Integration & Challenge
-- Progression: Increase terrain difficulty
-- Drill Balance: 40% Drill 1, 35% Drill 2, 25% Drill 3
-- Add Challenge: Speed, steeper terrain, variable snow
-- Target Metrics: [Updated goals]
-
-## Progress Checkpoints
-- After 5 runs: [What should improve first - usually awareness]
-- After 10 runs: [Expected metric changes]
-- After 20 runs: [Target achievements]
-- After 1 week: Take new CARV screenshots
-- After 2 weeks: Compare metrics, adjust drill focus
-
-## Mental Cues for This Skier
-Based on their specific pattern:
-- Primary Cue: "[3-5 words for their main focus]"
-- Transition Cue: "[For moving between turns]"
-- Confidence Cue: "[When they need to commit more]"
-
-## Common Traps to Avoid
-Based on their profile:
-- [Specific trap #1 they might fall into]
-- [Specific trap #2]
-- [What to do instead]
-
-Remember: Perfect practice makes perfect. 10 focused turns beat 100 mindless ones!
-"""
+
+def log_cache_usage(label, response):
+    """Log prompt-cache hit/miss token counts for a Claude response."""
+    usage = response.usage
+    app.logger.info(
+        "%s: cache_read_input_tokens=%s cache_creation_input_tokens=%s input_tokens=%s",
+        label,
+        getattr(usage, "cache_read_input_tokens", None),
+        getattr(usage, "cache_creation_input_tokens", None),
+        usage.input_tokens
+    )
 
 
 def get_media_type(filename):
     """Determine the media type from file extension."""
-    extension = filename.lower().split('.')[-1]
-    media_types = {
-        'png': 'image/png',
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'webp': 'image/webp',
-        'gif': 'image/gif'
-    }
-    return media_types.get(extension, 'image/png')
+    return MEDIA_TYPES.get(filename.rpartition('.')[2].lower(), 'image/png')
 
 
-def clean_json_response(response_text):
-    """Clean Claude's response to extract valid JSON."""
+def json_object_end(text, start):
+    """
+    Return the index just past the JSON object that opens at text[start].
+
+    Balances braces in a single forward scan, ignoring any inside strings.
+    Returns None if the object hasn't closed (yet).
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+
+    return None
+
+
+def extract_json(response_text):
+    """
+    Parse the JSON object in Claude's response, skipping any markdown fences or prose around it.
+
+    Raises orjson.JSONDecodeError if the response doesn't contain a valid object.
+    """
+    # Usually the response is the bare object, so skip the brace scan
     text = response_text.strip()
+    if text[:1] == '{' and text[-1:] == '}':
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass  # e.g. prose between two objects; fall back to the scan
 
-    # Remove markdown code blocks if present
-    if text.startswith('```'):
-        first_newline = text.find('\n')
-        if first_newline != -1:
-            text = text[first_newline + 1:]
-        if text.endswith('```'):
-            text = text[:-3]
-        text = text.strip()
+    start = response_text.find('{')
+    if start == -1:
+        raise orjson.JSONDecodeError("No JSON object in response", response_text, 0)
 
-    # Try to find JSON object boundaries
-    start_idx = text.find('{')
-    end_idx = text.rfind('}')
+    return orjson.loads(response_text[start:json_object_end(response_text, start)])
 
-    if start_idx != -1 and end_idx != -1:
-        text = text[start_idx:end_idx + 1]
 
-    return text
+def strip_exif_prefix(block):
+    """Drop the optional "Exif\\0\\0" header some writers put ahead of the TIFF data."""
+    return block[6:] if block[:6] == b'Exif\x00\x00' else block
+
+
+def png_text_exif(chunk_type, payload):
+    """
+    Decode the EXIF in a PNG tEXt/zTXt "Raw profile type exif" chunk, or return None.
+
+    The profile text is a blank line, the name, the byte count, then hex lines.
+    """
+    keyword, _, text = bytes(payload).partition(b'\x00')
+    if keyword != PNG_EXIF_PROFILE_KEYWORD:
+        return None
+
+    try:
+        if chunk_type == b'zTXt':
+            # One compression-method byte (always 0, zlib) precedes the stream
+            text = zlib.decompressobj().decompress(text[1:], PNG_EXIF_PROFILE_MAX_BYTES)
+        hex_lines = text.decode('latin-1').split('\n')[3:]
+        return strip_exif_prefix(bytes.fromhex(''.join(hex_lines)))
+    except (zlib.error, ValueError):
+        return None
+
+
+def find_exif_tiff(image_data):
+    """
+    Locate the EXIF TIFF block in a JPEG, PNG or WebP without decoding the image.
+
+    JPEG APP1 sits ahead of the image data, so only the first EXIF_SCAN_BYTES
+    are scanned for it. PNG and WebP may store EXIF after the image data, but
+    their chunk headers let the walk skip straight over it.
+    Returns a memoryview (or bytes) of the block, or None.
+    """
+    data = memoryview(image_data)
+    header = data[:EXIF_SCAN_BYTES]
+
+    if header[:2] == b'\xff\xd8':
+        # JPEG: walk the marker segments until APP1 "Exif" or the start of scan
+        pos = 2
+        while pos + 4 <= len(header):
+            if header[pos] != 0xFF:
+                return None
+            marker = header[pos + 1]
+            if marker == 0xFF:
+                pos += 1  # Fill byte
+                continue
+            if marker in (0xDA, 0xD9):
+                return None
+            segment_length = int.from_bytes(header[pos + 2:pos + 4], 'big')
+            if marker == 0xE1 and header[pos + 4:pos + 10] == b'Exif\x00\x00':
+                return header[pos + 10:pos + 2 + segment_length]
+            pos += 2 + segment_length
+
+    elif header[:8] == b'\x89PNG\r\n\x1a\n':
+        # PNG: walk every chunk for eXIf, falling back to a raw EXIF text profile
+        profile_exif = None
+        pos = 8
+        while pos + 8 <= len(data):
+            chunk_length = int.from_bytes(data[pos:pos + 4], 'big')
+            chunk_type = bytes(data[pos + 4:pos + 8])
+            payload = data[pos + 8:pos + 8 + chunk_length]
+            if chunk_type == b'eXIf':
+                return strip_exif_prefix(payload)
+            if chunk_type in (b'tEXt', b'zTXt') and profile_exif is None:
+                profile_exif = png_text_exif(chunk_type, payload)
+            if chunk_type == b'IEND':
+                break
+            pos += 12 + chunk_length
+        return profile_exif
+
+    elif header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        # WebP: walk the RIFF chunks until EXIF
+        pos = 12
+        while pos + 8 <= len(data):
+            chunk_type = data[pos:pos + 4]
+            chunk_length = int.from_bytes(data[pos + 4:pos + 8], 'little')
+            if chunk_type == b'EXIF':
+                return strip_exif_prefix(data[pos + 8:pos + 8 + chunk_length])
+            pos += 8 + chunk_length + (chunk_length & 1)
+
+    return None
+
+
+def read_ifd_tags(tiff, byte_order, offset, wanted_tags):
+    """Read the ASCII, LONG and IFD values of wanted_tags from the TIFF IFD at offset."""
+    values = {}
+    (entry_count,) = struct.unpack_from(byte_order + 'H', tiff, offset)
+
+    for index in range(entry_count):
+        entry = offset + 2 + 12 * index
+        tag, field_type, count, value = struct.unpack_from(byte_order + 'HHII', tiff, entry)
+        if tag not in wanted_tags:
+            continue
+        if field_type == 2:
+            # ASCII values longer than 4 bytes live at the offset in the value field
+            start = value if count > 4 else entry + 8
+            values[tag] = bytes(tiff[start:start + count]).rstrip(b'\x00 ').decode('ascii', 'replace')
+        elif field_type in (4, 13):
+            # LONG, or IFD (a sub-IFD offset some writers use for the EXIF pointer)
+            values[tag] = value
+
+    return values
+
+
+def parse_exif_datetime(value):
+    """
+    Parse an EXIF "YYYY:MM:DD HH:MM:SS" datetime by its fixed field offsets.
+
+    Much cheaper than strptime, which re-parses its format string on every call.
+    Raises ValueError if value isn't in that layout or isn't a valid date.
+    """
+    digits = value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]
+    # int() would also accept spaces, signs and underscores, which strptime rejects
+    if len(value) != 19 or value[4:17:3] != ':: ::' or not (digits.isascii() and digits.isdigit()):
+        raise ValueError(f"Not an EXIF datetime: {value!r}")
+    return datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19])
+    )
 
 
 def extract_exif_datetime(image_data):
-    """Extract datetime from image EXIF data."""
+    """Extract datetime from image EXIF data, reading only the EXIF header bytes."""
+    tiff = find_exif_tiff(image_data)
+    if tiff is None:
+        return None
+
     try:
-        image = Image.open(BytesIO(image_data))
-        exif_data = image._getexif()
-
-        if exif_data:
-            for tag_id, value in exif_data.items():
-                tag = TAGS.get(tag_id, tag_id)
-                # Look for DateTimeOriginal or DateTime
-                if tag in ['DateTimeOriginal', 'DateTime', 'DateTimeDigitized']:
-                    # EXIF datetime format: "YYYY:MM:DD HH:MM:SS"
-                    try:
-                        dt = datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
-                        return dt.isoformat()
-                    except ValueError:
-                        continue
+        byte_order = {b'II': '<', b'MM': '>'}.get(bytes(tiff[:2]))
+        if byte_order is None:
+            return None
+
+        (ifd0_offset,) = struct.unpack_from(byte_order + 'I', tiff, 4)
+        ifd0 = read_ifd_tags(tiff, byte_order, ifd0_offset, {EXIF_DATETIME, EXIF_IFD_POINTER})
+        exif_ifd = {}
+        # A corrupt file can store the pointer with the wrong type, e.g. as ASCII
+        exif_ifd_offset = ifd0.get(EXIF_IFD_POINTER)
+        if isinstance(exif_ifd_offset, int):
+            exif_ifd = read_ifd_tags(
+                tiff, byte_order, exif_ifd_offset, {EXIF_DATETIME_ORIGINAL, EXIF_DATETIME_DIGITIZED}
+            )
+    except (struct.error, TypeError, ValueError):
         return None
-    except Exception:
+
+    # Prefer DateTimeOriginal, then DateTime, then DateTimeDigitized
+    candidates = (
+        exif_ifd.get(EXIF_DATETIME_ORIGINAL),
+        ifd0.get(EXIF_DATETIME),
+        exif_ifd.get(EXIF_DATETIME_DIGITIZED)
+    )
+    for value in candidates:
+        if not value:
+            continue
+        try:
+            return parse_exif_datetime(value).isoformat()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def read_exif_source(file):
+    """
+    Read just enough of an upload to find its EXIF block.
+
+    JPEG keeps EXIF in the header, so multi-MB uploads are only read for their
+    first EXIF_SCAN_BYTES. PNG and WebP can store it after the image data.
+    """
+    image_data = file.stream.read(EXIF_SCAN_BYTES)
+    if image_data[:8] == b'\x89PNG\r\n\x1a\n' or (image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP'):
+        image_data += file.stream.read()
+    file.seek(0)  # Reset file pointer
+    return image_data
+
+
+def upload_metadata(file):
+    """Build the datetime metadata for one uploaded image, from EXIF or its filename."""
+    # Extract EXIF datetime
+    exif_datetime = extract_exif_datetime(read_exif_source(file))
+
+    metadata = {
+        "filename": file.filename,
+        "datetime": exif_datetime,
+        "datetime_source": "exif" if exif_datetime else None
+    }
+
+    # If no EXIF data, try to get from filename patterns
+    if not exif_datetime:
+        match = FILENAME_DATETIME_PATTERN.search(file.filename)
+        if match:
+            groups = SCREENSHOT_FILENAME_GROUPS if match.group('y1') else CAMERA_FILENAME_GROUPS
+            try:
+                year, month, day, hour, minute, second = map(int, match.group(*groups))
+                dt = datetime(year, month, day, hour, minute, second)
+                metadata["datetime"] = dt.isoformat()
+                metadata["datetime_source"] = "filename"
+            except ValueError:
+                pass
+
+    return metadata
+
+
+def average_scores(values):
+    """Average the numeric values, ignoring missing ones. Returns None if there are none."""
+    numbers = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+    if not numbers:
         return None
+    return round(sum(numbers) / len(numbers), 1)
+
+
+def aggregate_extractions(extractions):
+    """
+    Combine per-screenshot extractions into session-level numbers.
+
+    Extractions are model output, so fields of the wrong type are ignored.
+    """
+    readable = [e for e in extractions if not e.get("unreadable")]
+    metrics = [e["metrics"] for e in readable if isinstance(e.get("metrics"), dict)]
+
+    overall_metrics = {}
+    for category, metric_names in METRIC_CATEGORIES.items():
+        scores = {
+            name: average_scores(m.get(name) for m in metrics)
+            for name in metric_names
+        }
+        scores["category_average"] = average_scores(scores.values())
+        overall_metrics[category] = scores
+
+    ski_iqs = [e.get("ski_iq") for e in readable if isinstance(e.get("ski_iq"), (int, float))]
+    turns = [e.get("turns") for e in readable if isinstance(e.get("turns"), (int, float))]
+
+    # The most recent timestamp shown on any screenshot is the session's master timestamp
+    dated = [e for e in readable if isinstance(e.get("session_datetime"), str) and e["session_datetime"]]
+    latest = max(dated, key=lambda e: e["session_datetime"]) if dated else {}
+
+    return {
+        "session_overview": {
+            "total_screenshots": len(extractions),
+            "session_datetime": latest.get("session_datetime"),
+            "session_date_display": latest.get("session_date_display"),
+            "ski_iq_range": {
+                "lowest": min(ski_iqs) if ski_iqs else None,
+                "highest": max(ski_iqs) if ski_iqs else None,
+                "average": average_scores(ski_iqs)
+            },
+            "terrain_types_seen": sorted({
+                e["terrain_type"] for e in readable if isinstance(e.get("terrain_type"), str) and e["terrain_type"]
+            }),
+            "total_turns_analyzed": sum(turns) if turns else None
+        },
+        "overall_metrics": overall_metrics
+    }
+
+
+def read_upload(file):
+    """
+    Read an uploaded file in chunks, hashing and measuring it as it streams in.
+
+    Returns (sha256_digest, BytesIO) so the bytes are held once and hashed
+    without a second pass over the whole upload. Raises FileTooLargeError as
+    soon as the upload passes MAX_IMAGE_BYTES.
+    """
+    digest = hashlib.sha256()
+    upload = BytesIO()
+    file_size = 0
+
+    while True:
+        chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        file_size += len(chunk)
+        if file_size > MAX_IMAGE_BYTES:
+            raise FileTooLargeError(f"{file.filename} is larger than 5MB")
+        digest.update(chunk)
+        upload.write(chunk)
+
+    return digest.digest(), upload
+
+
+def prep_image(upload, filename):
+    """
+    Downscale a screenshot to MAX_IMAGE_EDGE and re-encode it as JPEG for Claude.
+
+    upload is a BytesIO holding the original file; it is read in place without copying.
+    JPEGs already within MAX_IMAGE_EDGE are sent as-is rather than re-encoded.
+
+    Uses libvips when pyvips is installed (several times faster than Pillow on
+    phone-sized screenshots), otherwise Pillow. Returns (media_type, base64_data).
+    Falls back to the original bytes if the image can't be read.
+    """
+    try:
+        # Only parses the header; pixels are decoded on first use
+        upload.seek(0)
+        image = Image.open(upload)
+    except OSError:
+        return get_media_type(filename), base64.standard_b64encode(upload.getbuffer()).decode('ascii')
+
+    if image.format == "JPEG" and max(image.size) <= MAX_IMAGE_EDGE:
+        return "image/jpeg", base64.standard_b64encode(upload.getbuffer()).decode('ascii')
+
+    if pyvips is not None:
+        try:
+            thumbnail = pyvips.Image.thumbnail_buffer(upload.getbuffer(), MAX_IMAGE_EDGE, height=MAX_IMAGE_EDGE, size="down")
+            if thumbnail.hasalpha():
+                thumbnail = thumbnail.flatten()
+            jpeg = thumbnail.colourspace("srgb").write_to_buffer(".jpg", Q=85, optimize_coding=True)
+            return "image/jpeg", base64.standard_b64encode(jpeg).decode('ascii')
+        except pyvips.Error:
+            pass  # Let Pillow have a go
+
+    try:
+        image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+        buffer = BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=85, optimize=True)
+    except OSError:
+        return get_media_type(filename), base64.standard_b64encode(upload.getbuffer()).decode('ascii')
+
+    return "image/jpeg", base64.standard_b64encode(buffer.getbuffer()).decode('ascii')
+
+
+def check_upload_sizes(files):
+    """
+    Reject oversized uploads up front, before any file is read or encoded.
+
+    Raises FileTooLargeError for the first file whose declared size exceeds
+    MAX_IMAGE_BYTES. Parts that don't declare a size are checked by
+    read_upload as they stream in.
+    """
+    for file in files:
+        if (file.content_length or 0) > MAX_IMAGE_BYTES:
+            raise FileTooLargeError(f"{file.filename} is larger than 5MB")
+
+
+def encode_image_uploads(files):
+    """
+    Base64-encode uploaded screenshots into Claude image content blocks.
+
+    Returns (image_contents, filenames, digests), where digests are the SHA-256
+    digests of the original uploads. Raises FileTooLargeError if any file
+    exceeds MAX_IMAGE_BYTES.
+    """
+    check_upload_sizes(files)
+
+    image_contents = []
+    filenames = []
+    digests = []
+
+    for file in files:
+        if file.filename == '':
+            continue
+
+        # Read (max 5MB each), downscale and encode image, reusing the result for repeat uploads
+        digest, upload = read_upload(file)
+        prepped = prepped_image_cache.get(digest)
+        if prepped is None:
+            prepped = prep_image(upload, file.filename)
+            prepped_image_cache.set(digest, prepped)
+        # Only the base64 copy is needed from here; drop the raw bytes before the next file
+        upload.close()
+        media_type, base64_image = prepped
+        digests.append(digest)
+
+        image_contents.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": base64_image
+            }
+        })
+        filenames.append(file.filename)
+
+    return image_contents, filenames, digests
+
+
+def analysis_cache_key(digests):
+    """Cache key for a screenshot set: upload order doesn't matter, prompt version does."""
+    return hashlib.sha256(b"".join(sorted(digests)) + PROMPT_VERSION.encode()).hexdigest()
+
+
+def cached_analysis(cache_key):
+    """
+    Look up an analysis in memory, then on disk. Returns None on a miss.
+
+    Callers add per-request fields to the result, so it is a copy of the cached dict.
+    """
+    analysis_data = analysis_memory_cache.get(cache_key)
+    if analysis_data is None:
+        analysis_data = analysis_cache.get(cache_key)
+        if analysis_data is None:
+            return None
+        analysis_memory_cache.set(cache_key, analysis_data)
+    return dict(analysis_data)
+
+
+def cache_analysis(cache_key, analysis_data):
+    """Store an analysis in both the in-process and on-disk caches."""
+    analysis_memory_cache.set(cache_key, dict(analysis_data))
+    analysis_cache.set(cache_key, analysis_data, expire=ANALYSIS_CACHE_TTL)
+
+
+def plan_cache_key(plan_request):
+    """Cache key for a training plan: the full Claude request, prompt and settings included."""
+    return hashlib.sha256(orjson.dumps(plan_request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def cache_bypassed():
+    """True when the request asks to skip cached results with ?nocache=1."""
+    return request.args.get('nocache') == '1'
+
+
+def api_error_payload(e, error, message):
+    """Map an exception from a Claude call to a JSON error payload and HTTP status."""
+    error_message = str(e)
+
+    if "api_key" in error_message.lower() or "authentication" in error_message.lower():
+        return {
+            "error": "API Key Error",
+            "message": "Your Anthropic API key is missing or invalid. Please check your .env file."
+        }, 401
+
+    if "rate_limit" in error_message.lower():
+        return {
+            "error": "Rate Limited",
+            "message": "Too many requests. Please wait a moment and try again."
+        }, 429
+
+    return {
+        "error": error,
+        "message": f"{message} Error: {error_message}"
+    }, 500
+
+
+def api_error_response(e, error, message):
+    """Map an exception from a Claude call to a JSON error response."""
+    return ojsonify(*api_error_payload(e, error, message))
+
+
+def ojsonify(payload, status=200):
+    """Serialize payload with orjson into a JSON response, bypassing Flask's jsonify."""
+    return Response(orjson.dumps(payload), status=status, mimetype="application/json")
+
+
+def build_training_plan_request(data):
+    """
+    Build the Claude request for a training plan from holistic analysis results.
+
+    Returns (request_params, ski_iq, num_runs).
+    """
+    # Extract key info for the prompt
+    ski_iq = "Unknown"
+    num_runs = data.get('num_screenshots', 1)
+
+    # Try to get Ski:IQ from session_overview
+    if 'session_overview' in data:
+        ski_iq_range = data['session_overview'].get('ski_iq_range', {})
+        avg_iq = ski_iq_range.get('average')
+        if avg_iq:
+            ski_iq = avg_iq
+
+    # Format analysis data for the prompt. analyzed_at changes on every request and
+    # means nothing to the coach, so leave it out to keep plans cacheable.
+    analysis_json = orjson.dumps(
+        {key: value for key, value in data.items() if key != 'analyzed_at'},
+        option=orjson.OPT_INDENT_2
+    ).decode()
+
+    # Create the prompt
+    prompt = render_prompt(
+        TRAINING_PLAN_PROMPT,
+        analysis_data=analysis_json,
+        ski_iq=ski_iq,
+        num_runs=num_runs
+    )
+
+    request_params = {
+        "model": MODEL_COACH,
+        "max_tokens": 4096,
+        "temperature": 0.3,
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        "system": cached_system_prompt(TRAINING_COACH_SYSTEM_PROMPT)
+    }
+
+    return request_params, ski_iq, num_runs
+
+
+def sse_event(data, event=None):
+    """Format a JSON payload as a server-sent event."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
+
+
+def create_training_plan(plan_request, use_cache=True):
+    """Return the training plan text for plan_request, from plan_cache when possible."""
+    cache_key = plan_cache_key(plan_request)
+    training_plan = plan_cache.get(cache_key) if use_cache else None
+
+    if training_plan is None:
+        response = get_client().messages.create(**plan_request)
+        log_cache_usage("generate-plan", response)
+        training_plan = response.content[0].text
+        # Don't keep serving a plan that was cut off at max_tokens
+        if response.stop_reason != "max_tokens":
+            plan_cache.set(cache_key, training_plan)
+
+    return training_plan
+
+
+def stream_training_plan(plan_request, ski_iq, num_runs, use_cache=True):
+    """
+    Yield the training plan as server-sent events while Claude generates it.
+
+    A plan already in plan_cache is sent as a single text event.
+    """
+    cache_key = plan_cache_key(plan_request)
+    training_plan = plan_cache.get(cache_key) if use_cache else None
+
+    try:
+        if training_plan is not None:
+            yield sse_event({"text": training_plan})
+        else:
+            chunks = []
+            with get_client().messages.stream(**plan_request) as stream:
+                for text in stream.text_stream:
+                    chunks.append(text)
+                    yield sse_event({"text": text})
+
+                final_message = stream.get_final_message()
+                log_cache_usage("generate-plan", final_message)
+
+            # Don't keep serving a plan that was cut off at max_tokens
+            if final_message.stop_reason != "max_tokens":
+                plan_cache.set(cache_key, "".join(chunks))
+
+    except Exception as e:
+        # Headers are already sent, so report failures in-stream
+        payload, status = api_error_payload(e, "Plan generation failed", "Something went wrong generating your training plan.")
+        yield sse_event({**payload, "status": status}, event="error")
+        return
+
+    yield sse_event({
+        "generated_at": datetime.now().isoformat(),
+        "based_on_ski_iq": ski_iq,
+        "based_on_screenshots": num_runs
+    }, event="done")
+
+
+def holistic_max_tokens(num_images):
+    """Output token cap for a holistic analysis of num_images screenshots."""
+    return HOLISTIC_MAX_TOKENS + HOLISTIC_MAX_TOKENS_PER_SCREENSHOT * num_images
+
+
+def recorded_analysis(message):
+    """Return the input of the record_analysis tool call, or None if it is missing or truncated."""
+    if message.stop_reason == "max_tokens":
+        return None
+
+    for block in message.content:
+        if block.type == "tool_use" and block.name == "record_analysis":
+            return block.input
+
+    return None
+
+
+def run_async(coro):
+    """Run a coroutine on the background event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_async_loop()).result()
+
+
+async def extract_metrics(image_block, image_number, num_images):
+    """
+    Read the visible session data and metrics off a single screenshot.
+
+    The response is streamed and the stream closed as soon as the JSON object
+    is complete, so any trailing prose isn't waited on.
+    """
+    chunks = []
+
+    async with get_async_client().messages.stream(
+        model=MODEL_EXTRACT,
+        max_tokens=512,
+        temperature=0,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    image_block,
+                    {
+                        "type": "text",
+                        "text": render_prompt(
+                            IMAGE_EXTRACTION_PROMPT,
+                            image_number=image_number,
+                            num_images=num_images
+                        )
+                    }
+                ]
+            }
+        ],
+        # Not marked for caching: the ~2.4K-token context is below Haiku 4.5's
+        # 4096-token minimum cacheable prompt, so a cache_control marker never hits
+        system=CARV_METRICS_CONTEXT
+    ) as stream:
+        async for text in stream.text_stream:
+            chunks.append(text)
+            if '}' in text:
+                response_text = "".join(chunks)
+                start = response_text.find('{')
+                if start != -1 and json_object_end(response_text, start) is not None:
+                    break
+
+    response_text = "".join(chunks)
+
+    try:
+        extraction = extract_json(response_text)
+    except orjson.JSONDecodeError:
+        # Let the holistic call work with what it has rather than failing the session
+        return {
+            "screenshot": image_number,
+            "unreadable": True,
+            "raw_response": response_text[:500]
+        }
+
+    # The task knows which screenshot this is; don't rely on the model echoing it
+    extraction["screenshot"] = image_number
+    return extraction
+
+
+async def synthesize_analysis(extractions):
+    """
+    Run the Sonnet coaching synthesis over per-screenshot extractions.
+
+    Returns the analysis dict, or None if Claude didn't record a complete analysis.
+    """
+    response = await get_async_client().messages.create(
+        model=MODEL_COACH,
+        max_tokens=holistic_max_tokens(len(extractions)),
+        temperature=0,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": render_prompt(
+                            SCREENSHOT_EXTRACTIONS_PREAMBLE,
+                            aggregate=orjson.dumps(aggregate_extractions(extractions), option=orjson.OPT_INDENT_2).decode(),
+                            extractions=orjson.dumps(extractions, option=orjson.OPT_INDENT_2).decode()
+                        )
+                    },
+                    {
+                        "type": "text",
+                        "text": render_prompt(HOLISTIC_ANALYSIS_PROMPT, num_images=len(extractions))
+                    }
+                ]
+            }
+        ],
+        system=cached_system_prompt(CARV_METRICS_CONTEXT),
+        tools=[RECORD_ANALYSIS_TOOL],
+        tool_choice={"type": "tool", "name": "record_analysis"}
+    )
+
+    log_cache_usage("analyze", response)
+
+    return recorded_analysis(response)
+
+
+def merge_late_extractions(analysis_data, extractions, late_extractions):
+    """
+    Fold screenshots that finished after the synthesis started into its analysis.
+
+    Session numbers and metric averages are recomputed in Python over every
+    screenshot; late screenshots contribute their own key observation as notes.
+    """
+    aggregate = aggregate_extractions(extractions)
+
+    analysis_data["overall_metrics"] = aggregate["overall_metrics"]
+    analysis_data.setdefault("session_overview", {}).update({
+        key: value for key, value in aggregate["session_overview"].items() if value is not None
+    })
+
+    notes = analysis_data.setdefault("run_by_run_notes", [])
+    notes.extend(
+        {"screenshot": e["screenshot"], "key_observation": e.get("key_observation")}
+        for e in late_extractions if not e.get("unreadable")
+    )
+    # Synthesis notes come from model output, so tolerate missing or non-integer numbers
+    notes.sort(key=lambda note: note.get("screenshot") if isinstance(note.get("screenshot"), int) else 0)
+
+
+async def analyze_images(image_contents):
+    """
+    Analyze screenshots holistically.
+
+    Each screenshot is extracted by its own concurrent Haiku call, the extractions
+    are aggregated in Python, and a single Sonnet call does the coaching synthesis.
+    The synthesis starts once EARLY_SYNTHESIS_FRACTION of the extractions are in,
+    overlapping with the stragglers, which are merged in afterwards.
+    Returns the analysis dict, or None if Claude didn't record a complete analysis.
+    """
+    num_images = len(image_contents)
+
+    tasks = [
+        asyncio.create_task(extract_metrics(image_block, image_number, num_images))
+        for image_number, image_block in enumerate(image_contents, start=1)
+    ]
+
+    try:
+        quorum = math.ceil(num_images * EARLY_SYNTHESIS_FRACTION)
+        pending = set(tasks)
+        while num_images - len(pending) < quorum:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+        # Keep upload order so screenshot numbering lines up
+        early_extractions = [task.result() for task in tasks if task not in pending]
+        analysis_data = await synthesize_analysis(early_extractions)
+
+        # The synthesis is already paid for, so a failed straggler is marked
+        # unreadable rather than failing the whole analysis
+        extractions = []
+        late_extractions = []
+        for image_number, task in enumerate(tasks, start=1):
+            if task not in pending:
+                extractions.append(task.result())
+                continue
+            try:
+                extraction = await task
+            except Exception as e:
+                app.logger.warning("Late extraction of screenshot %s failed: %s", image_number, e)
+                extraction = {"screenshot": image_number, "unreadable": True}
+            extractions.append(extraction)
+            late_extractions.append(extraction)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if analysis_data is not None and late_extractions:
+        merge_late_extractions(analysis_data, extractions, late_extractions)
+
+    return analysis_data
+
+
+def analyze_uploaded_screenshots():
+    """
+    Validate the request's 'images' uploads and analyze them, using the analysis cache.
+
+    Returns (analysis_data, None) on success or (None, error_response).
+    """
+    # Check if image files are present
+    if 'images' not in request.files:
+        return None, ojsonify({
+            "error": "No image files provided",
+            "message": "Please upload at least one CARV screenshot"
+        }, 400)
+
+    files = request.files.getlist('images')
+
+    if len(files) == 0 or (len(files) == 1 and files[0].filename == ''):
+        return None, ojsonify({
+            "error": "No files selected",
+            "message": "Please select at least one CARV screenshot to upload"
+        }, 400)
+
+    if len(files) > MAX_UPLOAD_FILES:
+        return None, ojsonify({
+            "error": "Too many files",
+            "message": f"Please upload at most {MAX_UPLOAD_FILES} screenshots at a time"
+        }, 413)
+
+    try:
+        image_contents, filenames, digests = encode_image_uploads(files)
+    except FileTooLargeError as e:
+        return None, ojsonify({
+            "error": "File too large",
+            "message": str(e)
+        }, 413)
+
+    num_images = len(image_contents)
+
+    if num_images == 0:
+        return None, ojsonify({
+            "error": "No valid images",
+            "message": "Please upload at least one valid image file"
+        }, 400)
+
+    cache_key = analysis_cache_key(digests)
+    analysis_data = None if cache_bypassed() else cached_analysis(cache_key)
+
+    if analysis_data is None:
+        # Extract each screenshot concurrently, then run the holistic analysis
+        analysis_data = run_async(analyze_images(image_contents))
+
+        if analysis_data is None:
+            return None, ojsonify({
+                "error": "Failed to parse AI response",
+                "message": "The AI response wasn't in the expected format. Please try again."
+            }, 500)
+
+        cache_analysis(cache_key, analysis_data)
+
+    # Add metadata
+    analysis_data["analyzed_at"] = datetime.now().isoformat()
+    analysis_data["filenames"] = filenames
+    analysis_data["num_screenshots"] = num_images
+
+    return analysis_data, None
 
 
 @app.route('/extract-metadata', methods=['POST'])
@@ -851,80 +1299,31 @@ def extract_metadata():
     """
     try:
         if 'images' not in request.files:
-            return jsonify({
+            return ojsonify({
                 "error": "No image files provided",
                 "message": "Please upload images to extract metadata"
-            }), 400
+            }, 400)
 
         files = request.files.getlist('images')
-        metadata_list = []
-
-        for file in files:
-            if file.filename == '':
-                continue
-
-            image_data = file.read()
-            file.seek(0)  # Reset file pointer
-
-            # Extract EXIF datetime
-            exif_datetime = extract_exif_datetime(image_data)
+        metadata_list = [upload_metadata(file) for file in files if file.filename != '']
 
-            metadata = {
-                "filename": file.filename,
-                "datetime": exif_datetime,
-                "datetime_source": "exif" if exif_datetime else None
-            }
-
-            # If no EXIF data, try to get from filename patterns
-            if not exif_datetime:
-                # Common screenshot naming patterns
-                import re
-                filename = file.filename
-                # Pattern: Screenshot 2024-01-15 at 10.30.45.png
-                pattern1 = r'(\d{4})-(\d{2})-(\d{2}).*?(\d{1,2})\.(\d{2})\.(\d{2})'
-                # Pattern: IMG_20240115_103045.jpg
-                pattern2 = r'(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})'
-
-                match = re.search(pattern1, filename)
-                if match:
-                    try:
-                        year, month, day, hour, minute, second = match.groups()
-                        dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
-                        metadata["datetime"] = dt.isoformat()
-                        metadata["datetime_source"] = "filename"
-                    except ValueError:
-                        pass
-
-                if not metadata["datetime"]:
-                    match = re.search(pattern2, filename)
-                    if match:
-                        try:
-                            year, month, day, hour, minute, second = match.groups()
-                            dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
-                            metadata["datetime"] = dt.isoformat()
-                            metadata["datetime_source"] = "filename"
-                        except ValueError:
-                            pass
-
-            metadata_list.append(metadata)
-
-        return jsonify({
+        return ojsonify({
             "metadata": metadata_list,
             "extracted_at": datetime.now().isoformat()
         })
 
     except Exception as e:
-        return jsonify({
+        return ojsonify({
             "error": "Metadata extraction failed",
             "message": str(e)
-        }), 500
+        }, 500)
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint to verify the backend is running."""
     api_key_configured = bool(os.getenv("ANTHROPIC_API_KEY"))
-    return jsonify({
+    return ojsonify({
         "status": "healthy",
         "api_key_configured": api_key_configured,
         "timestamp": datetime.now().isoformat()
@@ -937,127 +1336,206 @@ def analyze_screenshots():
     Analyze one or more CARV screenshots holistically using Claude's vision.
 
     Expects: multipart/form-data with one or more 'images' files
-    Returns: JSON with holistic analysis of all screenshots
+    Returns: JSON with holistic analysis of all screenshots; ?nocache=1 skips the cache
     """
     try:
-        # Check if image files are present
-        if 'images' not in request.files:
-            return jsonify({
-                "error": "No image files provided",
-                "message": "Please upload at least one CARV screenshot"
-            }), 400
+        analysis_data, error_response = analyze_uploaded_screenshots()
+        if error_response is not None:
+            return error_response
 
-        files = request.files.getlist('images')
+        return ojsonify(analysis_data)
 
-        if len(files) == 0 or (len(files) == 1 and files[0].filename == ''):
-            return jsonify({
-                "error": "No files selected",
-                "message": "Please select at least one CARV screenshot to upload"
-            }), 400
+    except Exception as e:
+        return api_error_response(e, "Analysis failed", "Something went wrong during analysis.")
 
-        # Process all images
-        image_contents = []
-        filenames = []
 
-        for file in files:
-            if file.filename == '':
-                continue
+@app.route('/analyze-and-plan', methods=['POST'])
+def analyze_and_plan():
+    """
+    Analyze CARV screenshots and generate the training plan in one round trip.
+
+    The plan depends on the analysis, so the two Claude stages still run in
+    sequence, but the client makes one request instead of two and doesn't have
+    to send the analysis back up.
 
-            # Check file size (max 5MB each)
-            file.seek(0, 2)
-            file_size = file.tell()
-            file.seek(0)
+    Expects: multipart/form-data with one or more 'images' files
+    Returns: JSON with the holistic analysis and the markdown training plan;
+             ?nocache=1 skips the caches
+    """
+    try:
+        analysis_data, error_response = analyze_uploaded_screenshots()
+        if error_response is not None:
+            return error_response
+
+        plan_request, ski_iq, num_runs = build_training_plan_request(analysis_data)
+        training_plan = create_training_plan(plan_request, use_cache=not cache_bypassed())
+
+        return ojsonify({
+            "analysis": analysis_data,
+            "training_plan": training_plan,
+            "generated_at": datetime.now().isoformat(),
+            "based_on_ski_iq": ski_iq,
+            "based_on_screenshots": num_runs
+        })
+
+    except Exception as e:
+        return api_error_response(e, "Analysis failed", "Something went wrong during analysis or plan generation.")
+
+
+@app.route('/analyze/batch', methods=['POST'])
+def create_analysis_batch():
+    """
+    Queue holistic analyses for several screenshot sets via the Message Batches API.
+
+    Batches run asynchronously at half the cost of regular calls, which suits
+    backfilling a skier's session history.
+
+    Expects: multipart/form-data where each screenshot set is uploaded under its
+             own field name (e.g. 'session_1', 'session_2'); the field name is
+             used as the session's custom_id
+    Returns: JSON with the batch id and status; poll GET /analyze/batch/<batch_id>
+    """
+    try:
+        session_ids = list(request.files.keys())
 
-            if file_size > 5 * 1024 * 1024:
-                return jsonify({
+        if not session_ids:
+            return ojsonify({
+                "error": "No image files provided",
+                "message": "Please upload at least one set of CARV screenshots"
+            }, 400)
+
+        # Check every session's files before encoding any of them
+        try:
+            for session_id in session_ids:
+                check_upload_sizes(request.files.getlist(session_id))
+        except FileTooLargeError as e:
+            return ojsonify({
+                "error": "File too large",
+                "message": str(e)
+            }, 413)
+
+        batch_requests = []
+
+        for session_id in session_ids:
+            if not BATCH_SESSION_ID_PATTERN.match(session_id):
+                return ojsonify({
+                    "error": "Invalid session id",
+                    "message": f"'{session_id}' must be 1-64 letters, digits, '_' or '-'"
+                }, 400)
+
+            try:
+                content_blocks, _, _ = encode_image_uploads(request.files.getlist(session_id))
+            except FileTooLargeError as e:
+                return ojsonify({
                     "error": "File too large",
-                    "message": f"{file.filename} is larger than 5MB"
-                }), 400
-
-            # Read and encode image
-            image_data = file.read()
-            base64_image = base64.standard_b64encode(image_data).decode('utf-8')
-            media_type = get_media_type(file.filename)
-
-            image_contents.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": media_type,
-                    "data": base64_image
-                }
+                    "message": str(e)
+                }, 413)
+
+            num_images = len(content_blocks)
+
+            if num_images == 0:
+                continue
+
+            # A batch request can't chain calls, so each session is analyzed in a
+            # single vision call rather than the per-screenshot extraction pipeline
+            content_blocks.append({
+                "type": "text",
+                "text": render_prompt(HOLISTIC_ANALYSIS_PROMPT, num_images=num_images)
             })
-            filenames.append(file.filename)
 
-        num_images = len(image_contents)
+            batch_requests.append({
+                "custom_id": session_id,
+                "params": {
+                    "model": MODEL_COACH,
+                    "max_tokens": holistic_max_tokens(num_images),
+                    "temperature": 0,
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": content_blocks
+                        }
+                    ],
+                    # Batches can take well over 5 minutes, so keep the context cached for an hour
+                    "system": cached_system_prompt(CARV_METRICS_CONTEXT, ttl="1h"),
+                    "tools": [RECORD_ANALYSIS_TOOL],
+                    "tool_choice": {"type": "tool", "name": "record_analysis"}
+                }
+            })
 
-        if num_images == 0:
-            return jsonify({
+        if not batch_requests:
+            return ojsonify({
                 "error": "No valid images",
                 "message": "Please upload at least one valid image file"
-            }), 400
+            }, 400)
 
-        # Build the message content with all images + prompt
-        message_content = image_contents.copy()
-        message_content.append({
-            "type": "text",
-            "text": HOLISTIC_ANALYSIS_PROMPT.format(num_images=num_images)
-        })
+        batch = get_client().messages.batches.create(requests=batch_requests)
 
-        # Call Claude API with all images
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": message_content
-                }
-            ],
-            system=CARV_METRICS_CONTEXT
-        )
+        return ojsonify({
+            "batch_id": batch.id,
+            "processing_status": batch.processing_status,
+            "session_ids": [r["custom_id"] for r in batch_requests],
+            "created_at": datetime.now().isoformat()
+        }, 202)
 
-        # Extract response text
-        response_text = response.content[0].text
+    except Exception as e:
+        return api_error_response(e, "Batch creation failed", "Something went wrong queuing the batch.")
 
-        # Clean and parse JSON
-        cleaned_json = clean_json_response(response_text)
 
-        try:
-            analysis_data = json.loads(cleaned_json)
-        except json.JSONDecodeError as e:
-            return jsonify({
-                "error": "Failed to parse AI response",
-                "message": "The AI response wasn't in the expected format. Please try again.",
-                "raw_response": response_text[:500]
-            }), 500
+@app.route('/analyze/batch/<batch_id>', methods=['GET'])
+def get_analysis_batch(batch_id):
+    """
+    Poll a batch created by POST /analyze/batch.
 
-        # Add metadata
-        analysis_data["analyzed_at"] = datetime.now().isoformat()
-        analysis_data["filenames"] = filenames
-        analysis_data["num_screenshots"] = num_images
+    Returns: JSON with the batch status, plus per-session analyses once it has ended
+    """
+    try:
+        batch = get_client().messages.batches.retrieve(batch_id)
+
+        response_data = {
+            "batch_id": batch.id,
+            "processing_status": batch.processing_status,
+            "request_counts": {
+                "processing": batch.request_counts.processing,
+                "succeeded": batch.request_counts.succeeded,
+                "errored": batch.request_counts.errored,
+                "canceled": batch.request_counts.canceled,
+                "expired": batch.request_counts.expired
+            }
+        }
 
-        return jsonify(analysis_data)
+        if batch.processing_status != "ended":
+            return ojsonify(response_data)
 
-    except Exception as e:
-        error_message = str(e)
+        results = {}
+
+        for entry in get_client().messages.batches.results(batch_id):
+            if entry.result.type != "succeeded":
+                results[entry.custom_id] = {
+                    "error": "Analysis failed",
+                    "message": f"Batch request {entry.result.type}"
+                }
+                continue
+
+            message = entry.result.message
+            log_cache_usage(f"batch {entry.custom_id}", message)
+            analysis_data = recorded_analysis(message)
+
+            if analysis_data is None:
+                results[entry.custom_id] = {
+                    "error": "Failed to parse AI response",
+                    "message": "The AI response wasn't in the expected format."
+                }
+                continue
+
+            analysis_data["analyzed_at"] = batch.ended_at.isoformat() if batch.ended_at else None
+            results[entry.custom_id] = analysis_data
 
-        if "api_key" in error_message.lower() or "authentication" in error_message.lower():
-            return jsonify({
-                "error": "API Key Error",
-                "message": "Your Anthropic API key is missing or invalid. Please check your .env file."
-            }), 401
+        response_data["results"] = results
 
-        if "rate_limit" in error_message.lower():
-            return jsonify({
-                "error": "Rate Limited",
-                "message": "Too many requests. Please wait a moment and try again."
-            }), 429
+        return ojsonify(response_data)
 
-        return jsonify({
-            "error": "Analysis failed",
-            "message": f"Something went wrong during analysis. Error: {error_message}"
-        }), 500
+    except Exception as e:
+        return api_error_response(e, "Batch lookup failed", "Something went wrong fetching the batch.")
 
 
 @app.route('/generate-plan', methods=['POST'])
@@ -1066,77 +1544,34 @@ def generate_training_plan():
     Generate a personalized training plan based on holistic analysis results.
 
     Expects: JSON with analysis data
-    Returns: Markdown formatted training plan
+    Returns: Markdown formatted training plan, or a text/event-stream of plan
+             text chunks when the request sends Accept: text/event-stream;
+             ?nocache=1 skips the plan cache
     """
     try:
         data = request.get_json()
 
         if not data:
-            return jsonify({
+            return ojsonify({
                 "error": "No analysis data provided",
                 "message": "Please analyze screenshots first before generating a training plan"
-            }), 400
-
-        # Extract key info for the prompt
-        ski_iq = "Unknown"
-        num_runs = data.get('num_screenshots', 1)
-
-        # Try to get Ski:IQ from session_overview
-        if 'session_overview' in data:
-            ski_iq_range = data['session_overview'].get('ski_iq_range', {})
-            avg_iq = ski_iq_range.get('average')
-            if avg_iq:
-                ski_iq = avg_iq
+            }, 400)
 
-        # Format analysis data for the prompt
-        analysis_json = json.dumps(data, indent=2)
+        plan_request, ski_iq, num_runs = build_training_plan_request(data)
+        use_cache = not cache_bypassed()
 
-        # Create the prompt
-        prompt = TRAINING_PLAN_PROMPT.format(
-            analysis_data=analysis_json,
-            ski_iq=ski_iq,
-            num_runs=num_runs
-        )
+        # Stream the plan as server-sent events when the client asks for it
+        if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+            return Response(
+                stream_with_context(stream_training_plan(plan_request, ski_iq, num_runs, use_cache)),
+                mimetype='text/event-stream',
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
 
         # Call Claude API for training plan
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            system="""You are an elite ski coach with deep expertise in carving biomechanics and CARV technology.
-
-Your knowledge is based on proven carving principles:
-- A carved turn means the ski tail follows the exact arc of the tip (train on tracks)
-- The 4 pillars: Edge Angle, Fore/Aft Balance, Rotary Control, Pressure Management
-- G-force is a RESULT of good technique, not the goal itself
-- Clean edge lock leaves a single thin line in snow
-
-When creating training plans:
-1. ALWAYS select drills from the provided Drill Library - these are proven, specific exercises
-2. Match drills to the specific metric deficiencies identified
-3. Use the Drill Selection Framework to pick appropriate drills
-4. Include detailed execution instructions, not vague suggestions
-5. Provide specific mental cues (3-5 words max)
-6. Be encouraging but honest about what needs work
-7. Use actual scores from the analysis
-8. Structure sessions: Warm-up → Focus Phase → Integration → Cool-down
-
-Key principles:
-- Quality over quantity (10 perfect turns beat 100 sloppy ones)
-- One focus at a time during practice
-- Progress from easy terrain to challenging
-- Build on strengths to fix weaknesses
-- Address root causes, not just symptoms"""
-        )
+        training_plan = create_training_plan(plan_request, use_cache)
 
-        training_plan = response.content[0].text
-
-        return jsonify({
+        return ojsonify({
             "training_plan": training_plan,
             "generated_at": datetime.now().isoformat(),
             "based_on_ski_iq": ski_iq,
@@ -1144,24 +1579,7 @@ Key principles:
         })
 
     except Exception as e:
-        error_message = str(e)
-
-        if "api_key" in error_message.lower() or "authentication" in error_message.lower():
-            return jsonify({
-                "error": "API Key Error",
-                "message": "Your Anthropic API key is missing or invalid. Please check your .env file."
-            }), 401
-
-        if "rate_limit" in error_message.lower():
-            return jsonify({
-                "error": "Rate Limited",
-                "message": "Too many requests. Please wait a moment and try again."
-            }), 429
-
-        return jsonify({
-            "error": "Plan generation failed",
-            "message": f"Something went wrong generating your training plan. Error: {error_message}"
-        }), 500
+        return api_error_response(e, "Plan generation failed", "Something went wrong generating your training plan.")
 
 
 if __name__ == '__main__':
@@ -1177,4 +1595,6 @@ if __name__ == '__main__':
         print("API Key: Configured")
         print("="*60 + "\n")
 
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # Development server only; run under gunicorn (see gunicorn.conf.py) otherwise.
+    # The debugger and reloader are opt-in with FLASK_DEBUG=1.
+    app.run(host='0.0.0.0', port=5001, debug=os.getenv("FLASK_DEBUG") == "1", threaded=True)
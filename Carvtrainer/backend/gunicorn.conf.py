@@ -0,0 +1,31 @@
+"""
+Gunicorn configuration for the CARV Analyzer backend.
+
+Run from the backend directory:
+    gunicorn app.main:app
+
+Requests spend most of their time waiting on the Claude API, so threaded
+workers let many in-flight calls overlap despite the GIL. Tune threads
+against your Anthropic rate limits.
+
+gevent workers are deliberately not used: monkey-patching would turn the
+background asyncio loop thread that drives the per-screenshot calls into a
+greenlet, blocking it behind whichever request is running.
+"""
+
+import multiprocessing
+
+bind = "0.0.0.0:5001"
+
+worker_class = "gthread"
+workers = 2 * multiprocessing.cpu_count()
+threads = 16
+
+# Holistic analyses and non-streamed training plans can take well over a minute
+timeout = 180
+keepalive = 5
+
+# main.py creates its Anthropic clients and async event loop thread lazily on the
+# first request, but the disk cache and HTTP pools still shouldn't be shared
+# across fork(), so each worker imports the app itself
+preload_app = False
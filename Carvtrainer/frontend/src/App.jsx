@@ -206,15 +206,70 @@ function App() {
 
     setPlanLoading(true)
     setError(null)
+    setTrainingPlan(null)
+
+    let reader = null
 
     try {
-      const response = await axios.post('/api/generate-plan', analysis)
-      setTrainingPlan(response.data.training_plan)
+      // Stream the plan so it renders as Claude writes it
+      const response = await fetch('/api/generate-plan', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Accept': 'text/event-stream'
+        },
+        body: JSON.stringify(analysis)
+      })
+
+      if (!response.ok) {
+        const data = await response.json().catch(() => ({}))
+        throw new Error(data.message || data.error || 'Failed to generate training plan')
+      }
+
+      reader = response.body.getReader()
+      const decoder = new TextDecoder()
+      let buffer = ''
+      let plan = ''
+      let completed = false
+
+      while (true) {
+        const { done, value } = await reader.read()
+        if (done) break
+
+        // Server-sent events are separated by a blank line
+        buffer += decoder.decode(value, { stream: true })
+        const events = buffer.split('\n\n')
+        buffer = events.pop()
+
+        for (const rawEvent of events) {
+          let eventType = 'message'
+          let data = ''
+          rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event: ')) eventType = line.slice(7)
+            else if (line.startsWith('data: ')) data += line.slice(6)
+          })
+          if (!data) continue
+
+          const payload = JSON.parse(data)
+          if (eventType === 'error') {
+            throw new Error(payload.message || payload.error || 'Failed to generate training plan')
+          }
+          if (eventType === 'message') {
+            plan += payload.text
+            setTrainingPlan(plan)
+          }
+          if (eventType === 'done') completed = true
+        }
+      }
+
+      if (!completed) {
+        throw new Error('The training plan was cut off. Please try again.')
+      }
     } catch (err) {
-      const errorMessage = err.response?.data?.message ||
-                          err.response?.data?.error ||
-                          'Failed to generate training plan'
-      setError(errorMessage)
+      // Stop reading and drop the partial plan so it can't be saved as complete
+      if (reader) reader.cancel().catch(() => {})
+      setTrainingPlan(null)
+      setError(err.message || 'Failed to generate training plan')
     } finally {
       setPlanLoading(false)
     }